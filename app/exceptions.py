@@ -50,6 +50,15 @@ def group_orders_by_exception(exceptions):
     return
 
 
+# Function to write a log entry timestamped at cursor_datetime, so get_last_log_time() returns it
+def log_cursor(message, cursor_datetime):
+    logger = logging.getLogger()
+    record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, message, None, None)
+    record.created = cursor_datetime.timestamp()
+    record.msecs = cursor_datetime.microsecond // 1000
+    logger.handle(record)
+
+
 def get_last_log_time():
 
     # Read the log file
@@ -62,3 +71,8 @@ def get_last_log_time():
             return last_log_entry.split(' - ')[0]
         else:
             raise Exception("Log file is empty")
+
+
+# Raised when the Qualer API is unavailable (503) and the caller asked not to wait for it
+class QualerUnavailableError(Exception):
+    pass
@@ -3,6 +3,11 @@ from bs4 import BeautifulSoup
 import re
 import json
 import traceback
+import threading
+import time
+from collections import Counter
+
+import app.tracing as tracing
 
 ###########################################################################################################
 ############################################### Outlook API ###############################################
@@ -31,7 +36,13 @@ def get_access_token():
 access_token = get_access_token()
 calendar_id = 'AAMkAGEwOWUyZDEzLTQ1MTktNDNkMy1hZmZiLTQxZjZmNGVmNGZlMABGAAAAAACxzJLn1GFkQpJCvD31IsIGBwAxNg00JTgmTqbPLRQZN89GAAAAAAEHAAAxNg00JTgmTqbPLRQZN89GAAjGS-TTAAA='
 user_id = 'sysop@jgiquality.com'
-endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/'
+graph_root = 'https://graph.microsoft.com/v1.0'
+endpoint = f'{graph_root}/users/{user_id}/'
+BATCH_SIZE = 20  # Graph accepts at most 20 requests in one $batch call
+THROTTLE_RETRIES = 5  # Times a throttled (429) request is resent before giving up
+DEFAULT_RETRY_AFTER = 5  # Seconds to wait after a 429 that has no Retry-After header
+call_counts = Counter()  # Number of Graph API requests made, by function name
+call_counts_lock = threading.Lock()  # Counter increments aren't atomic, and technician calendar writes run on worker threads
 headers = {
     'Authorization': 'Bearer ' + access_token,
     'Prefer': 'outlook.timezone = "America/Chicago"',
@@ -39,6 +50,43 @@ headers = {
 }
 
 
+# Function to get the events URL of a calendar: the shared calendar by default, or the default calendar of a mailbox
+def calendar_events_url(mailbox=None):
+    if mailbox is None:
+        return f'{endpoint}calendars/{calendar_id}/events'
+    return f'{graph_root}/users/{mailbox}/calendar/events'
+
+
+# Function to get the URL of a single event, in the shared mailbox by default
+def event_url(event_id, mailbox=None):
+    if mailbox is None:
+        return f"{endpoint}events/{event_id}"
+    return f"{graph_root}/users/{mailbox}/events/{event_id}"
+
+
+# Function to count a Graph API request
+def count_call(name):
+    with call_counts_lock:
+        call_counts[name] += 1
+
+
+# Function to get the seconds Graph asked to wait before resending a throttled request
+def retry_after(response_headers):
+    return int(response_headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+
+
+# Function to make a Graph request within a span, resending it after the Retry-After delay while it is throttled (429)
+def send_request(span, send, *args, **kwargs):
+    for attempt in range(THROTTLE_RETRIES + 1):
+        count_call(span.name)
+        response = span.request(send, *args, **kwargs)
+        if response.status_code != 429 or attempt == THROTTLE_RETRIES:
+            return response
+        wait = retry_after(response.headers)
+        print(f"{span.name} was throttled. Waiting {wait} seconds...")
+        time.sleep(wait)
+
+
 # Function to format an error message from outlook API
 def outlook_error_handler(error):
     error_code = error['code']
@@ -89,10 +137,11 @@ def check_outlook_event(ServiceOrderId, CustomOrderNumber, id_array):
 
 
 # C: Function to create an Outlook calendar event
-def create_outlook_event(event):
-    url = f'{endpoint}calendars/{calendar_id}/events'
+def create_outlook_event(event, mailbox=None):
+    url = calendar_events_url(mailbox)
     data = event
-    response = requests.post(url, headers=headers, json=data)
+    with tracing.span("create_outlook_event") as span:
+        response = send_request(span, requests.post, url, headers=headers, json=data)
 
     if response.status_code == 201:
         print('Event created successfully for ' + event['bodyPreview'] + '.')
@@ -105,60 +154,62 @@ def create_outlook_event(event):
     return response.json()
 
 
-# R: Function to retrieve Outlook calendar events
-def get_outlook_events():
+# R: Function to retrieve Outlook calendar events. params adds query options, e.g. a $filter or $select.
+def get_outlook_events(mailbox=None, params=None):
     global access_token
     first_attempt = True  # Flag to indicate if this is the first attempt to get the events
-    url = f'{endpoint}calendars/{calendar_id}/events'  # Endpoint to get the events
+    url = calendar_events_url(mailbox)  # Endpoint to get the events
     events = {}  # Initialize the events dictionary
     skip = 0  # Initial value for $skip
     top = 1000  # Maximum value for $top (max 1000 events per request)
 
-    while True:
-        params = {'$top': top, '$skip': skip}
-        response = requests.get(url, headers=headers, params=params)
-
-        try:
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            if response.status_code == 401 and first_attempt:
-                access_token = get_access_token()
-                first_attempt = False
-                continue
-            else:
-                print(f"HTTPError: {e}")
-                print("Response content:", response.content)
+    with tracing.span("get_outlook_events") as span:
+        while True:
+            page_params = dict(params or {}, **{'$top': top, '$skip': skip})
+            response = send_request(span, requests.get, url, headers=headers, params=page_params)
+
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                if response.status_code == 401 and first_attempt:
+                    access_token = get_access_token()
+                    first_attempt = False
+                    continue
+                else:
+                    print(f"HTTPError: {e}")
+                    print("Response content:", response.content)
+                    traceback.print_exc()
+                    raise
+
+            try:
+                data = response.json()
+            except json.decoder.JSONDecodeError:
+                print("JSONDecodeError: ", response.content)
                 traceback.print_exc()
                 raise
 
-        try:
-            data = response.json()
-        except json.decoder.JSONDecodeError:
-            print("JSONDecodeError: ", response.content)
-            traceback.print_exc()
-            raise
-
-        if not data:
-            if not first_attempt:
-                raise Exception(outlook_error_handler(data.get('error', {})))
-            else:
-                first_attempt = False
-                continue
+            if not data:
+                if not first_attempt:
+                    raise Exception(outlook_error_handler(data.get('error', {})))
+                else:
+                    first_attempt = False
+                    continue
 
-        events['value'] = events.get('value', []) + data['value']
-        if len(data['value']) < top:
-            break
+            events['value'] = events.get('value', []) + data['value']
+            if len(data['value']) < top:
+                break
 
-        skip += top
+            skip += top
 
     return events
 
 
 # U: Function to update an Outlook event
-def update_outlook_event(event_id, event, attendees_only=False):
-    url = f"{endpoint}events/{event_id}"
+def update_outlook_event(event_id, event, attendees_only=False, mailbox=None):
+    url = event_url(event_id, mailbox)
     request_body = json.loads('{"attendees":' + json.dumps(event['attendees']) + '}') if attendees_only else event
-    response = requests.patch(url, headers=headers, data=json.dumps(request_body))
+    with tracing.span("update_outlook_event") as span:
+        response = send_request(span, requests.patch, url, headers=headers, data=json.dumps(request_body))
 
     # Check the response status
     if response.status_code == 200:
@@ -170,9 +221,10 @@ def update_outlook_event(event_id, event, attendees_only=False):
 
 
 # D: Function to delete an Outlook event
-def delete_outlook_event(event_id):
-    url = f"{endpoint}events/{event_id}"
-    response = requests.delete(url, headers=headers)
+def delete_outlook_event(event_id, mailbox=None):
+    url = event_url(event_id, mailbox)
+    with tracing.span("delete_outlook_event") as span:
+        response = send_request(span, requests.delete, url, headers=headers)
 
     # Check the response status
     if response.status_code == 204:
@@ -182,3 +234,60 @@ def delete_outlook_event(event_id):
         print('Failed to delete event.')
         print(response.content)
         raise Exception("Delete error: ", response.text)
+
+
+#######################################################################################
+##################################  Batch Operations  #################################
+#######################################################################################
+
+
+# Function to build a $batch request, which uses URLs relative to the Graph root
+def batch_request(method, url, body=None):
+    request = {"method": method, "url": url.replace(graph_root, '', 1)}
+    if body is not None:
+        request["headers"] = {"Content-Type": "application/json"}
+        request["body"] = body
+    return request
+
+
+# Function to build the $batch request that creates an event
+def create_event_request(event, mailbox=None):
+    return batch_request("POST", calendar_events_url(mailbox), event)
+
+
+# Function to build the $batch request that updates an event
+def update_event_request(event_id, event, attendees_only=False, mailbox=None):
+    return batch_request("PATCH", event_url(event_id, mailbox), {"attendees": event['attendees']} if attendees_only else event)
+
+
+# Function to build the $batch request that deletes an event
+def delete_event_request(event_id, mailbox=None):
+    return batch_request("DELETE", event_url(event_id, mailbox))
+
+
+# Function to send up to BATCH_SIZE requests in one $batch call, returning their responses in the same order.
+# Throttled requests are resent after the longest Retry-After the batch asked for.
+def send_batch(batch_requests):
+    pending = {str(i): request for i, request in enumerate(batch_requests)}
+    responses = {}
+    for attempt in range(THROTTLE_RETRIES + 1):
+        count_call("send_batch")
+        with tracing.span("send_batch") as span:
+            response = span.request(requests.post, f'{graph_root}/$batch', headers=headers, json={"requests": [dict(request, id=request_id) for request_id, request in pending.items()]})
+        if response.status_code != 200:
+            print(f"Batch request failed: {response.content}")
+            raise Exception("Batch error: ", response.text)
+
+        wait = 0
+        for item in response.json()["responses"]:
+            responses[item["id"]] = item
+            if item["status"] == 429 and attempt < THROTTLE_RETRIES:
+                wait = max(wait, retry_after(item.get("headers", {})))
+            else:
+                pending.pop(item["id"], None)
+        if not pending:
+            break
+        print(f"{len(pending)} batched requests were throttled. Waiting {wait} seconds...")
+        time.sleep(wait)
+
+    return [responses[str(i)] for i in range(len(batch_requests))]
@@ -0,0 +1,142 @@
+import json
+import math
+from datetime import datetime as dt
+
+import app.outlook as ol
+
+###########################################################################################################
+################################################ Sync Plan ################################################
+###########################################################################################################
+
+PLAN_VERSION = 1
+
+# Results that require a Graph API write, and the verb used to describe them
+WRITE_RESULTS = {
+    "Created": "created",
+    "Updated": "updated",
+    "Cancelled": "deleted",
+}
+
+
+# Function to build the planned action for an order
+def make_action(order, result, event_id=None, changed_fields=None, payload=None):
+    return {
+        "result": result,
+        "ServiceOrderId": order["ServiceOrderId"],
+        "CustomOrderNumber": order["CustomOrderNumber"],
+        "event_id": event_id or None,
+        "changed_fields": changed_fields or [],
+        "payload": payload,
+        "applied": False,
+    }
+
+
+# Function to count the Outlook writes in a list of actions, by result
+def count_writes(actions):
+    writes = {}
+    for action in actions:
+        if action["result"] in WRITE_RESULTS:
+            writes[action["result"]] = writes.get(action["result"], 0) + 1
+    return writes
+
+
+# Function to predict the Graph API calls needed to apply a list of actions (writes are sent in $batch calls)
+def estimate_apply_calls(actions):
+    writes = sum(count_writes(actions).values())
+    return {"send_batch": math.ceil(writes / ol.BATCH_SIZE)} if writes else {}
+
+
+# Function to write a sync plan, along with the API calls spent building it and predicted for applying it
+def write_plan(path, actions, start_date, stop_date, qualer_calls, graph_calls):
+    apply_calls = estimate_apply_calls(actions)
+    plan = {
+        "version": PLAN_VERSION,
+        "created": dt.now().isoformat(timespec='seconds'),
+        "window": {
+            "start": start_date.isoformat(),
+            "stop": stop_date.isoformat(),
+        },
+        "writes": count_writes(actions),
+        "estimate": {
+            "plan": {
+                "qualer": dict(qualer_calls),
+                "graph": dict(graph_calls),
+            },
+            "apply": {
+                "qualer": {},
+                "graph": apply_calls,
+            },
+        },
+        "actions": actions,
+    }
+    save_plan(path, plan)
+    return plan
+
+
+# Function to read a sync plan written by write_plan
+def load_plan(path):
+    with open(path, 'r') as file:
+        plan = json.load(file)
+    if plan.get("version") != PLAN_VERSION:
+        raise Exception(f"Unsupported sync plan version: {plan.get('version')}")
+    return plan
+
+
+# Function to save a sync plan, e.g. after marking its actions as applied
+def save_plan(path, plan):
+    with open(path, 'w') as file:
+        json.dump(plan, file, indent=2)
+
+
+# Function to print the planned writes and the predicted API calls of a plan
+def print_estimate(plan):
+    writes = plan.get("writes", {})
+    print(f"Planned writes: {sum(writes.values())} {writes if writes else ''}")
+    for phase, apis in plan["estimate"].items():
+        for api, calls in apis.items():
+            print(f"{phase.capitalize()} {api.capitalize()} calls: {sum(calls.values())} {calls if calls else ''}")
+
+
+# Function to perform the Outlook write for a planned action
+def apply_action(action):
+    result = action["result"]
+    if result == "Created":
+        ol.create_outlook_event(action["payload"])
+    elif result == "Updated":
+        ol.update_outlook_event(action["event_id"], action["payload"], action["changed_fields"] == ['attendees'])
+    elif result == "Cancelled":
+        ol.delete_outlook_event(action["event_id"])
+
+
+# Function to check whether a sync has run since the plan was written, so its payloads may be out of date.
+# last_log_time is the timestamp returned by ex.get_last_log_time().
+def is_stale(plan, last_log_time):
+    return dt.strptime(last_log_time, "%Y-%m-%d %H:%M:%S,%f") > dt.fromisoformat(plan["created"])
+
+
+# Function to build the $batch request for a planned write
+def action_request(action):
+    result = action["result"]
+    if result == "Created":
+        return ol.create_event_request(action["payload"])
+    elif result == "Updated":
+        return ol.update_event_request(action["event_id"], action["payload"], action["changed_fields"] == ['attendees'])
+    return ol.delete_event_request(action["event_id"])
+
+
+# Function to apply planned writes in $batch calls, yielding (action, error message or None) as each batch completes
+def apply_actions(actions):
+    for i in range(0, len(actions), ol.BATCH_SIZE):
+        chunk = actions[i:i + ol.BATCH_SIZE]
+        responses = ol.send_batch([action_request(action) for action in chunk])
+        for action, response in zip(chunk, responses):
+            if response["status"] in (200, 201, 204):
+                yield action, None
+            else:
+                error = (response.get("body") or {}).get("error", {"code": response["status"], "message": ""})
+                yield action, ol.outlook_error_handler(error)
+
+
+# Function to describe a planned action that was not applied
+def describe_action(action):
+    return f"Would have {WRITE_RESULTS[action['result']]} event for {action['CustomOrderNumber']} if live"
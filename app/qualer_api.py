@@ -1,9 +1,18 @@
+import copy
 import requests
 import json
 import time
 import os
+import threading
+from collections import Counter
+
+import app.exceptions as ex
+import app.tracing as tracing
 
 LIVE = False  # Set to True to run the script in live mode, False to run in test mode
+call_counts = Counter()  # Number of Qualer API requests made, by function name
+call_counts_lock = threading.Lock()  # Counter increments aren't atomic, and requests can be made from worker threads
+attendee_cache = {}  # Outlook attendees already looked up this run, by EmployeeId
 
 ###########################################################################################################
 ############################################ Qualer API Calls #############################################
@@ -56,6 +65,12 @@ QUALER_API_HEADERS = {
 }
 
 
+# Function to count a Qualer API request
+def count_call(name):
+    with call_counts_lock:
+        call_counts[name] += 1
+
+
 # Function to handle Qualer API response errors
 def qualer_error_handler(response):
     if response.status_code == 200:
@@ -82,56 +97,74 @@ def qualer_error_handler(response):
         raise Exception(f"Qualer API error: {response.status_code} {response.text}")
 
 
-# Function to retrieve future work orders from Qualer API
-def get_work_orders(start, end):
-    while True:
-        start_time = start.strftime('%Y-%m-%dT%H:%M:%S.%f')
-        end_time = end.strftime('%Y-%m-%dT%H:%M:%S.%f')
-        response = requests.get(QUALER_API_ENDPOINT + f"/service/workorders?status=OnSite&from={start_time}&to={end_time}", headers=QUALER_API_HEADERS)
-        work_orders = qualer_error_handler(response)
-        if work_orders is not None:
-            return work_orders
+# Function to retrieve future work orders from Qualer API.
+# Set wait_if_unavailable to False to raise QualerUnavailableError on a 503, instead of waiting and retrying.
+def get_work_orders(start, end, timeout=None, wait_if_unavailable=True):
+    with tracing.span("get_work_orders") as span:
+        while True:
+            start_time = start.strftime('%Y-%m-%dT%H:%M:%S.%f')
+            end_time = end.strftime('%Y-%m-%dT%H:%M:%S.%f')
+            count_call("get_work_orders")
+            response = span.request(requests.get, QUALER_API_ENDPOINT + f"/service/workorders?status=OnSite&from={start_time}&to={end_time}", headers=QUALER_API_HEADERS, timeout=timeout)
+            if response.status_code == 503 and not wait_if_unavailable:
+                raise ex.QualerUnavailableError(f"503 Error: Qualer API unavailable for work orders between {start_time} and {end_time}")
+            work_orders = qualer_error_handler(response)
+            if work_orders is not None:
+                return work_orders
 
 
 # Function to retrieve work order details from Qualer API
 def get_work_order(workOrderNumber):
-    while True:
-        response = requests.get(QUALER_API_ENDPOINT + f"/service/workorders?workOrderNumber={workOrderNumber}", headers=QUALER_API_HEADERS)
-        if qualer_error_handler(response) is not None:
-            return response.json()
+    with tracing.span("get_work_order") as span:
+        while True:
+            count_call("get_work_order")
+            response = span.request(requests.get, QUALER_API_ENDPOINT + f"/service/workorders?workOrderNumber={workOrderNumber}", headers=QUALER_API_HEADERS)
+            if qualer_error_handler(response) is not None:
+                return response.json()
 
 
 # Function to count assets on an order
 def count_assets(serviceOrderId):
-    while True:
-        response = requests.get(QUALER_API_ENDPOINT + f"/service/workorders/{serviceOrderId}/workitems", headers=QUALER_API_HEADERS)
-        if qualer_error_handler(response) is not None:
-            return len(response.json())
+    with tracing.span("count_assets") as span:
+        while True:
+            count_call("count_assets")
+            response = span.request(requests.get, QUALER_API_ENDPOINT + f"/service/workorders/{serviceOrderId}/workitems", headers=QUALER_API_HEADERS)
+            if qualer_error_handler(response) is not None:
+                return len(response.json())
 
 
 # Function to retrieve assignments for an order from Qualer API
 def get_work_order_assignments(serviceOrderId):
-    while True:
-        response = requests.get(QUALER_API_ENDPOINT + f"/service/workorders/{serviceOrderId}/assignments", headers=QUALER_API_HEADERS)
-        if qualer_error_handler(response) is not None:
-            return response.json()
+    with tracing.span("get_work_order_assignments") as span:
+        while True:
+            count_call("get_work_order_assignments")
+            response = span.request(requests.get, QUALER_API_ENDPOINT + f"/service/workorders/{serviceOrderId}/assignments", headers=QUALER_API_HEADERS)
+            if qualer_error_handler(response) is not None:
+                return response.json()
 
 
-# Function to look up an employee and transform the data into a format suitable for an Outlook calendar event attendee
+# Function to look up an employee and transform the data into a format suitable for an Outlook calendar event attendee.
+# Employees are looked up once per run; later calls return a copy of the cached attendee.
 def prepare_outlook_event_attendee(EmployeeId):
-    while True:
-        response = requests.get(QUALER_API_ENDPOINT + f"/employees/{EmployeeId}", headers=QUALER_API_HEADERS)
-        if qualer_error_handler(response) is not None:
-            api_response = response.json()  # Extract the API response as JSON data
-
-            # Transform the employee information into a format suitable for an Outlook calendar event attendee
-            transformed_data = {
-                "type": "required",
-                "emailAddress": {
-                    "name": f"{api_response['FirstName']} {api_response['LastName']}",
-                    "address": api_response['SubscriptionEmail']
+    if EmployeeId in attendee_cache:
+        return copy.deepcopy(attendee_cache[EmployeeId])
+
+    with tracing.span("prepare_outlook_event_attendee") as span:
+        while True:
+            count_call("prepare_outlook_event_attendee")
+            response = span.request(requests.get, QUALER_API_ENDPOINT + f"/employees/{EmployeeId}", headers=QUALER_API_HEADERS)
+            if qualer_error_handler(response) is not None:
+                api_response = response.json()  # Extract the API response as JSON data
+
+                # Transform the employee information into a format suitable for an Outlook calendar event attendee
+                transformed_data = {
+                    "type": "required",
+                    "emailAddress": {
+                        "name": f"{api_response['FirstName']} {api_response['LastName']}",
+                        "address": api_response['SubscriptionEmail']
+                    }
                 }
-            }
-            return transformed_data
-        else:
-            return qualer_error_handler(response)
+                attendee_cache[EmployeeId] = transformed_data
+                return copy.deepcopy(transformed_data)
+            else:
+                return qualer_error_handler(response)
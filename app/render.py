@@ -0,0 +1,247 @@
+from datetime import datetime as dt
+from datetime import time, timedelta
+from functools import lru_cache
+
+###########################################################################################################
+############################################# Event Rendering #############################################
+###########################################################################################################
+
+TIME_ZONE = "America/Chicago"
+SERVICE_ORDER_URL = "https://jgiquality.qualer.com/ServiceOrder/Info/"
+BODY_PLACEHOLDER = '<p class="MsoNormal"></p>'
+DEFAULT_START_TIME = time(7, 0)  # Default start time is 7:00 AM
+DEFAULT_END_TIME = time(17, 0)  # Default end time is 5:00 PM
+
+# Keys to compare between Qualer and Outlook, to determine whether or not to update an event
+COMPARED_KEYS = (
+    'subject',
+    'bodyPreview',
+    'allowNewTimeProposals',
+    'isAllDay',
+    'categories',
+    'showAs',
+    'responseRequested',
+    'isReminderOn',
+    'isCancelled'
+)
+
+
+# Precompiled body.html: the template is split around the placeholder paragraph once, so rendering is a single concatenation
+class BodyTemplate:
+    __slots__ = ('prefix', 'suffix')
+
+    def __init__(self, html):
+        head, placeholder, tail = html.partition(BODY_PLACEHOLDER)
+        if not placeholder:
+            raise Exception(f"Body template is missing the placeholder {BODY_PLACEHOLDER}")
+        self.prefix = head + '<p class="MsoNormal">'
+        self.suffix = '</p>' + tail
+
+    def render(self, body_content):
+        return self.prefix + body_content + self.suffix
+
+
+# Function to read and precompile the body template
+def load_body_template(path):
+    with open(path, 'r') as file:
+        return BodyTemplate(file.read())
+
+
+# Function that parses Qualer datetimes (e.g. "2024-05-01T00:00:00"). Orders share many of the same date and time strings, so results are cached.
+@lru_cache(maxsize=4096)
+def parse_qualer_datetime(datetime_str):
+    return dt.fromisoformat(datetime_str)
+
+
+# Function that parses Outlook datetimes (e.g. "2024-05-01T07:00:00.0000000"). fromisoformat only takes 6 fractional digits, so the 7th is dropped.
+@lru_cache(maxsize=4096)
+def parse_outlook_datetime(datetime_str):
+    return dt.fromisoformat(datetime_str[:26])
+
+
+# Function that formats a datetime the way events are sent to Outlook
+def format_event_datetime(datetime_obj):
+    return datetime_obj.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+# Normalized Qualer order: every field needed to render and compare an event, parsed exactly once
+class OrderRecord:
+    __slots__ = (
+        'service_order_id',
+        'custom_order_number',
+        'order_status',
+        'client_company_name',
+        'address',
+        'to_date',
+        'start',
+        'end',
+        'is_all_day',
+        'error',
+    )
+
+    def __init__(self, service_order_id, custom_order_number, order_status, client_company_name, address, to_date, start, end, is_all_day, error=None):
+        self.service_order_id = service_order_id
+        self.custom_order_number = custom_order_number
+        self.order_status = order_status
+        self.client_company_name = client_company_name
+        self.address = address
+        self.to_date = to_date  # Date of RequestToDate, used to skip past orders
+        self.start = start
+        self.end = end
+        self.is_all_day = is_all_day
+        self.error = error  # Why start and end couldn't be determined; raised when the event is rendered
+
+
+# Function to parse a Qualer date string, or return None if the date is missing
+def parse_qualer_date(date_str):
+    return parse_qualer_datetime(date_str).date() if isinstance(date_str, str) else None
+
+
+# Function to determine the start, end, and all day flag for an order from its already parsed dates.
+# If dates are missing, raises an exception. If times are both missing, assumes all day event.
+def parse_schedule(order, from_date, to_date):
+    from_time_str = order.get("RequestFromTime")
+    to_time_str = order.get("RequestToTime")
+
+    if from_date is None or to_date is None:
+        fields = {"RequestFromTime": from_time_str, "RequestToTime": to_time_str, "RequestFromDate": order.get("RequestFromDate"), "RequestToDate": order.get("RequestToDate")}
+        missing_values = [field for field, value in fields.items() if not value]
+        raise Exception("Order is missing values: " + ", ".join(missing_values) + ".")
+
+    # If no values are missing, assume the event is not all day
+    if isinstance(from_time_str, str) and isinstance(to_time_str, str):
+        request_from = dt.combine(from_date, parse_qualer_datetime(from_time_str).time())
+        request_to = dt.combine(to_date, parse_qualer_datetime(to_time_str).time())
+        # Check if the event ends before it starts
+        if request_from > request_to:
+            # If both times are AM, and the end time is before the start time, assume the end time is supposed to be PM
+            if request_to.time() < time(12, 0):
+                request_to += timedelta(hours=12)
+                print("Order ends before it starts. Correcting end time from AM to PM on outlook.  Please make corrections on Qualer manually.")
+                print(SERVICE_ORDER_URL + str(order["ServiceOrderId"]))
+            else:
+                raise Exception("Order ends before it starts. Make manual corrections on Qualer: " + SERVICE_ORDER_URL + str(order["ServiceOrderId"]))
+        return request_from, request_to, False
+
+    # If both times are missing, assume the event is all day
+    if from_time_str is None and to_time_str is None:
+        print(f"Order {order['ServiceOrderId']} has missing times. Assuming all day event.")
+        return dt.combine(from_date, time.min), dt.combine(to_date, time.min) + timedelta(days=1), True
+
+    # Use default times if only one of the times is missing
+    start_time = parse_qualer_datetime(from_time_str).time() if from_time_str else DEFAULT_START_TIME
+    end_time = parse_qualer_datetime(to_time_str).time() if to_time_str else DEFAULT_END_TIME
+    return dt.combine(from_date, start_time), dt.combine(to_date, end_time), False
+
+
+# Function to parse a raw Qualer work order into an OrderRecord. Each date and time string is parsed once.
+# A schedule that can't be determined doesn't raise here, so past and cancelled orders can still be handled.
+def parse_order(order):
+    address = order["ShippingAddress"]
+    to_date = parse_qualer_date(order.get("RequestToDate"))
+    try:
+        start, end, is_all_day = parse_schedule(order, parse_qualer_date(order.get("RequestFromDate")), to_date)
+        error = None
+    except Exception as e:
+        start, end, is_all_day, error = None, None, None, e
+    return OrderRecord(
+        service_order_id=order["ServiceOrderId"],
+        custom_order_number=order["CustomOrderNumber"],
+        order_status=order["OrderStatus"],
+        client_company_name=order["ClientCompanyName"],
+        address=f"{address['Address1']}, {address['City']}, {address['StateProvinceAbbreviation']} {address['ZipPostalCode']}",
+        to_date=to_date,
+        start=start,
+        end=end,
+        is_all_day=is_all_day,
+        error=error,
+    )
+
+
+# Function to render the Outlook event for an order record
+def render_event(record, attendees, asset_count, template):
+    if record.error is not None:
+        raise record.error
+    order_status = record.order_status
+    hyperlink = f'<a href="{SERVICE_ORDER_URL}{record.service_order_id}">{record.custom_order_number}</a>'
+    body_content = f"<b>{hyperlink}<br> Number of Assets:</b> {asset_count}"
+
+    # Prepare dictionary object for Outlook calendar event
+    return {
+        "subject": record.client_company_name,
+        "bodyPreview": record.custom_order_number,
+        "allowNewTimeProposals": False,
+        "body": {
+            "contentType": "html",
+            "content": template.render(body_content)
+        },
+        "isAllDay": record.is_all_day,
+        "start": {
+            "dateTime": format_event_datetime(record.start),
+            "timeZone": TIME_ZONE
+        },
+        "end": {
+            "dateTime": format_event_datetime(record.end),
+            "timeZone": TIME_ZONE
+        },
+        "location": {
+            "displayName": record.address,
+            "locationType": "default"
+        },
+        "attendees": attendees,
+        "categories": [],
+        "showAs": "tentative" if order_status == "Scheduling" else "busy" if order_status == "Processing" else "free",
+        "responseRequested": False,
+        "isReminderOn": False,
+        "isCancelled": order_status == "Cancelled",
+    }
+
+
+# Function to normalize an Outlook event into the same shape render_event produces, so the two can be compared
+def normalize_outlook_event(event):
+    normalized = {key: event[key] for key in COMPARED_KEYS}
+
+    # The body may be left out of the listing ($select), since it isn't compared
+    if 'body' in event:
+        normalized['body'] = {
+            'contentType': event['body']['contentType'],
+            'content': event['body']['content']
+        }
+
+    # Round-trip the datetimes through datetime objects, so both sides are formatted by format_event_datetime
+    normalized['start'] = {
+        'dateTime': format_event_datetime(parse_outlook_datetime(event['start']['dateTime'])),
+        'timeZone': event['start']['timeZone']
+    }
+
+    normalized['end'] = {
+        'dateTime': format_event_datetime(parse_outlook_datetime(event['end']['dateTime'])),
+        'timeZone': event['end']['timeZone']
+    }
+
+    normalized['location'] = {
+        'displayName': event['location']['displayName'],
+        'locationType': event['location']['locationType']
+    }
+
+    normalized['attendees'] = [
+        {
+            'type': attendee['type'],
+            # Remove ".onmicrosoft" from email addresses, just in case it's there
+            'emailAddress': dict(attendee['emailAddress'], address=attendee['emailAddress']['address'].replace('.onmicrosoft', ''))
+        }
+        for attendee in event['attendees']
+    ]
+
+    return normalized
+
+
+# Function to compare two event objects and return a list of keys whose values differ between the two events
+def compare_events(event1, event2):
+    differing_keys = []
+    for key in event1:
+        if key == "body":  # or key == "bodyPreview":
+            continue  # Do not check the body or bodyPreview keys; there are too many formatting discrepancies
+        elif event1[key] != event2.get(key):
+            differing_keys.append(key)
+    return differing_keys
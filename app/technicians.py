@@ -0,0 +1,168 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app.outlook as ol
+import app.plan as plan
+import app.render as render
+import app.tracing as tracing
+
+###########################################################################################################
+######################################## Technician Calendar Fan-out ######################################
+###########################################################################################################
+
+MAX_WORKERS = 8  # Graph requests in flight across all mailboxes
+MAILBOX_CONCURRENCY = 4  # Graph allows 4 concurrent requests per mailbox
+MAILBOX_INTERVAL = 0.25  # Minimum seconds between starting requests to the same mailbox
+TECHNICIAN_CATEGORY = "Qualer Sync"  # Marks the copies this sync writes, so a technician's own events are never changed
+
+# Only marked copies are listed, without their bodies, which aren't compared
+INDEX_PARAMS = {
+    '$filter': f"categories/any(c:c eq '{TECHNICIAN_CATEGORY}')",
+    '$select': ','.join(('id', 'isOrganizer', 'start', 'end', 'location', 'attendees') + render.COMPARED_KEYS),
+}
+
+
+# Limits the requests made to one mailbox, so a technician with many orders doesn't get the whole run throttled
+class MailboxThrottle:
+
+    def __init__(self):
+        self.semaphore = threading.Semaphore(MAILBOX_CONCURRENCY)
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            wait = self.next_start - time.monotonic()
+            self.next_start = max(self.next_start, time.monotonic()) + MAILBOX_INTERVAL
+        if wait > 0:
+            time.sleep(wait)
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+
+
+# Keeps each assigned technician's own calendar in step with the events rendered for the shared calendar.
+# Orders are added during the normal sync pass, so the Qualer lookups and rendering are reused, not repeated per mailbox.
+class TechnicianSync:
+
+    def __init__(self, is_live):
+        self.is_live = is_live
+        self.orders = {}  # CustomOrderNumber -> (ServiceOrderId, rendered event, or None if the order is cancelled)
+        self.mailboxes = set()
+        self.results = {"Created": 0, "Updated": 0, "Cancelled": 0, "Skipped": 0}
+        self.exceptions = []  # [CustomOrderNumber, message] pairs, in the format of calendar_sync's exceptions
+        self.lock = threading.Lock()
+
+    # Function to add the event rendered for an order. Pass None to remove a cancelled order from every technician calendar.
+    # previous_event is the order's existing shared calendar event, if any; its attendees' calendars are checked too,
+    # so copies held by technicians who were unassigned are deleted.
+    def add(self, order, event, previous_event=None):
+        self.orders[order["CustomOrderNumber"]] = (str(order["ServiceOrderId"]), event)
+        for source in (event, previous_event):
+            if source is not None:
+                self.mailboxes.update(attendee_mailbox(attendee) for attendee in source.get("attendees", []))
+
+    # Function to bring every technician calendar up to date
+    def run(self):
+        mailboxes = sorted(self.mailboxes)
+        if not mailboxes:
+            return self.results
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Build the per-mailbox event index from one Graph listing per mailbox
+            indexes = dict(zip(mailboxes, executor.map(self.index_mailbox, mailboxes)))
+            print(f"Found {sum(len(index['ids']) for index in indexes.values() if index)} events in {len(mailboxes)} technician calendars")
+
+            throttles = {mailbox: MailboxThrottle() for mailbox in mailboxes}
+            # A mailbox is only synced for an order it is assigned to or already holds a copy of.
+            # Tasks are interleaved by order, so the workers spread over many mailboxes instead of queueing on one.
+            tasks = [
+                (mailbox, custom_order_number, service_order_id, event)
+                for custom_order_number, (service_order_id, event) in self.orders.items()
+                for mailbox in mailboxes
+                if is_assigned(event, mailbox) or (indexes[mailbox] is not None and custom_order_number in indexes[mailbox]["orders"])
+            ]
+            list(executor.map(lambda task: self.sync_event(indexes[task[0]], throttles[task[0]], *task), tasks))
+
+        return self.results
+
+    # Function to list the copies in a mailbox's calendar and index them by order, or None if the listing fails.
+    # Only events marked with TECHNICIAN_CATEGORY that the mailbox organizes are indexed; the technician's own events
+    # and invitations from the shared calendar are left alone.
+    def index_mailbox(self, mailbox):
+        try:
+            events = ol.get_outlook_events(mailbox, INDEX_PARAMS)
+        except Exception as e:
+            print(f"Could not list events for {mailbox}: {e}")
+            return None
+        events = {'value': [event for event in events.get('value', []) if event.get('isOrganizer') and TECHNICIAN_CATEGORY in event.get('categories', [])]}
+        ids = ol.extract_event_details(events)
+        return {
+            "ids": ids,
+            "orders": {custom_order_number for _, custom_order_number, _ in ids if custom_order_number},
+            "events": {event['id']: event for event in events['value']},
+        }
+
+    # Function to sync one order's event in one technician's calendar, recording the result or failure
+    def sync_event(self, index, throttle, mailbox, custom_order_number, service_order_id, event):
+        assigned = is_assigned(event, mailbox)
+        if index is None:
+            if assigned:
+                self.record_failure(mailbox, custom_order_number, "Could not list technician calendar events")
+            return
+
+        try:
+            result = self.write_event(index, throttle, mailbox, custom_order_number, service_order_id, event if assigned else None)
+        except Exception as e:
+            self.record_failure(mailbox, custom_order_number, e)
+            return
+
+        with self.lock:
+            self.results[result] += 1
+
+    # Function to make the Graph write that brings one technician calendar event in line with the rendered event, and return the result
+    def write_event(self, index, throttle, mailbox, custom_order_number, service_order_id, event):
+        event_id = ol.check_outlook_event(service_order_id, custom_order_number, index["ids"])
+
+        if event is not None:
+            # The technician's copy has no attendees, so writing it never sends invitations
+            mailbox_event = dict(event, attendees=[], categories=[TECHNICIAN_CATEGORY])
+            if not event_id:
+                result = "Created"
+            elif render.compare_events(render.normalize_outlook_event(index["events"][event_id]), mailbox_event):
+                result = "Updated"
+            else:
+                return "Skipped"
+        elif event_id:
+            result = "Cancelled"
+        else:
+            return "Skipped"
+
+        # Throttle waits are kept out of the trace, and the write is grouped under the order without adding to its processing time
+        with throttle, tracing.order(custom_order_number, timed=False):
+            if not self.is_live:
+                print(f"Would have {plan.WRITE_RESULTS[result]} event for {custom_order_number} in {mailbox} if live")
+            elif result == "Created":
+                ol.create_outlook_event(mailbox_event, mailbox)
+            elif result == "Updated":
+                ol.update_outlook_event(event_id, mailbox_event, mailbox=mailbox)
+            else:
+                ol.delete_outlook_event(event_id, mailbox)
+        return result
+
+    # Function to record a failed technician calendar write
+    def record_failure(self, mailbox, custom_order_number, error):
+        with self.lock:
+            self.exceptions.append([custom_order_number, f"{mailbox}: {error}"])
+
+
+# Function to get the mailbox of an event attendee
+def attendee_mailbox(attendee):
+    return attendee['emailAddress']['address'].replace('.onmicrosoft', '').lower()
+
+
+# Function to check whether a mailbox is an attendee of a rendered event (None for a cancelled order)
+def is_assigned(event, mailbox):
+    return event is not None and any(attendee_mailbox(attendee) == mailbox for attendee in event["attendees"])
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+###########################################################################################################
+################################################# Tracing #################################################
+###########################################################################################################
+
+ORDER_SPAN = "process_order"
+
+spans = []  # Finished spans, in the order they finished
+local = threading.local()  # local.order is the CustomOrderNumber that new spans on this thread are grouped under
+trace_epoch = time.time() - time.perf_counter()  # Converts perf_counter readings to wall clock time
+
+
+# A timed operation: one API call (including its retries), or the processing of one order
+class Span:
+    __slots__ = ('name', 'order', 'thread_id', 'start', 'duration', 'attempts', 'response_bytes', 'status_code', 'error')
+
+    def __init__(self, name, order):
+        self.name = name
+        self.order = order
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.attempts = 0
+        self.response_bytes = 0
+        self.status_code = None
+        self.error = None  # Type of the exception that ended the span or its last failed request, e.g. "Timeout"
+
+    # Function to record one HTTP request made within the span
+    def attempt(self, response):
+        self.attempts += 1
+        self.response_bytes += len(response.content)
+        self.status_code = response.status_code
+
+    # Function to record one HTTP request that raised before a response arrived
+    def attempt_failed(self, exception):
+        self.attempts += 1
+        self.error = type(exception).__name__
+
+    # Function to make an HTTP request within the span, recording it whether or not a response arrives
+    def request(self, send, *args, **kwargs):
+        try:
+            response = send(*args, **kwargs)
+        except Exception as e:
+            self.attempt_failed(e)
+            raise
+        self.attempt(response)
+        return response
+
+    @property
+    def retries(self):
+        return max(self.attempts - 1, 0)
+
+
+# Context manager that times an API call, grouped under the current order
+@contextmanager
+def span(name):
+    current = Span(name, getattr(local, 'order', None))
+    try:
+        yield current
+    except Exception as e:
+        if current.error is None:
+            current.error = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        spans.append(current)
+
+
+# Context manager that groups the spans created inside it under a CustomOrderNumber.
+# Set timed to False to group without recording another processing span for the order.
+@contextmanager
+def order(custom_order_number, timed=True):
+    previous_order = getattr(local, 'order', None)
+    local.order = custom_order_number
+    try:
+        if timed:
+            with span(ORDER_SPAN):
+                yield
+        else:
+            yield
+    finally:
+        local.order = previous_order
+
+
+# Function to total the spans of each order
+def summarize_orders():
+    orders = {}
+    for s in spans:
+        if s.order is None:
+            continue
+        summary = orders.setdefault(s.order, {"order": s.order, "seconds": 0.0, "api_calls": 0, "retries": 0, "response_bytes": 0, "errors": [], "slowest_call": None, "slowest_seconds": 0.0})
+        if s.name == ORDER_SPAN:
+            summary["seconds"] += s.duration
+            continue
+        summary["api_calls"] += s.attempts
+        summary["retries"] += s.retries
+        summary["response_bytes"] += s.response_bytes
+        if s.error:
+            summary["errors"].append(f"{s.name}: {s.error}")
+        if s.duration > summary["slowest_seconds"]:
+            summary["slowest_call"] = s.name
+            summary["slowest_seconds"] = s.duration
+    return list(orders.values())
+
+
+# Function to print the slowest and most API-heavy orders of the run
+def print_report(limit=10):
+    orders = summarize_orders()
+    if not orders:
+        return
+
+    print(f"Slowest {min(limit, len(orders))} orders:")
+    for summary in sorted(orders, key=lambda o: o["seconds"], reverse=True)[:limit]:
+        print(f"  {summary['order']}: {summary['seconds']:.2f}s, slowest call {summary['slowest_call']} ({summary['slowest_seconds']:.2f}s)")
+    print()
+
+    print(f"Most API-heavy {min(limit, len(orders))} orders:")
+    for summary in sorted(orders, key=lambda o: (o["api_calls"], o["response_bytes"]), reverse=True)[:limit]:
+        print(f"  {summary['order']}: {summary['api_calls']} calls ({summary['retries']} retries), {summary['response_bytes']:,} bytes")
+    print()
+
+    failed = [summary for summary in orders if summary["errors"]]
+    if failed:
+        print(f"Orders with failed calls: {len(failed)}")
+        for summary in failed[:limit]:
+            print(f"  {summary['order']}: {', '.join(summary['errors'])}")
+        print()
+
+
+# Function to export the spans in the Chrome Trace Event format, which chrome://tracing and ui.perfetto.dev can open
+def export_chrome_trace(path):
+    events = []
+    for s in spans:
+        events.append({
+            "name": s.name,
+            "cat": "order" if s.name == ORDER_SPAN else "api",
+            "ph": "X",
+            "ts": int((trace_epoch + s.start) * 1_000_000),
+            "dur": int(s.duration * 1_000_000),
+            "pid": os.getpid(),
+            "tid": s.thread_id,
+            "args": {
+                "order": s.order,
+                "attempts": s.attempts,
+                "retries": s.retries,
+                "response_bytes": s.response_bytes,
+                "status_code": s.status_code,
+                "error": s.error,
+            },
+        })
+    with open(path, 'w') as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,141 @@
+import json
+import os
+from datetime import datetime as dt
+from datetime import timedelta
+
+import requests
+
+import app.exceptions as ex
+
+###########################################################################################################
+########################################## Adaptive Fetch Windows #########################################
+###########################################################################################################
+
+DEFAULT_DAYS = 7  # Window size used when there is no order density history
+MIN_DAYS = 1  # Windows are never split below this size
+MAX_DAYS = 62  # Windows are never widened above this size
+TARGET_ORDERS = 150  # Number of orders a window is sized to return
+MAX_ORDERS = 400  # Responses larger than this are split and refetched
+REQUEST_TIMEOUT = 60  # Seconds to wait for a work order response before splitting the window
+HISTORY_DAYS = 90  # Days of history kept per calendar month; older totals are scaled down so density can change over time
+
+
+# Sizes the windows passed to get_work_orders from the order density of recent windows and previous runs.
+# Density (orders per day) is remembered per calendar month, since busy and quiet seasons repeat every year.
+class WindowPlanner:
+
+    def __init__(self, fetch, history_path):
+        self.fetch = fetch
+        self.history_path = history_path
+        self.months = {}  # "MM" -> {"orders": ..., "days": ..., "max_days": ...}
+        self.covered_until = None  # End of the last window recorded, so overlapping runs don't count orders twice
+        self.max_days = MAX_DAYS  # Largest window size this run, lowered whenever a window has to be split
+        if os.path.exists(history_path):
+            with open(history_path, 'r') as file:
+                history = json.load(file)
+            self.months = history.get("months", {})
+            if history.get("covered_until"):
+                self.covered_until = dt.fromisoformat(history["covered_until"])
+
+    # Function to get the remembered order density for the calendar month of a date, or None if unknown
+    def density(self, date):
+        period = self.months.get(date.strftime('%m'))
+        if not period or not period["days"]:
+            return None
+        return period["orders"] / period["days"]
+
+    # Function to get the largest window size that is known to work for the calendar month of a date
+    def max_days_for(self, date):
+        period = self.months.get(date.strftime('%m'), {})
+        return min(self.max_days, period.get("max_days", MAX_DAYS))
+
+    # Function to split a window that timed out or returned too many orders, returning the new window size.
+    # The split size becomes the limit for the rest of the run and, in the history, for the window's calendar month.
+    def split(self, window_start, window_days):
+        days = max(window_days / 2, MIN_DAYS)
+        self.max_days = min(self.max_days, days)
+        period = self.months.setdefault(window_start.strftime('%m'), {"orders": 0, "days": 0})
+        period["max_days"] = min(period.get("max_days", MAX_DAYS), days)
+        return days
+
+    # Function to remember the orders found in a window, spread evenly over the days of each month it covers
+    def record(self, start, end, order_count):
+        total_days = (end - start) / timedelta(days=1)
+        if self.covered_until is not None and start < self.covered_until:
+            start = min(self.covered_until, end)  # Skip the part of the window an earlier window or run already recorded
+        if start >= end:
+            return
+
+        segment_start = start
+        while segment_start < end:
+            next_month = (segment_start.replace(day=1, hour=0, minute=0, second=0, microsecond=0) + timedelta(days=32)).replace(day=1)
+            segment_end = min(next_month, end)
+            days = (segment_end - segment_start) / timedelta(days=1)
+            period = self.months.setdefault(segment_start.strftime('%m'), {"orders": 0, "days": 0})
+            period["orders"] += order_count * days / total_days
+            period["days"] += days
+            if period["days"] > HISTORY_DAYS:
+                scale = HISTORY_DAYS / period["days"]
+                period["orders"] *= scale
+                period["days"] = HISTORY_DAYS
+            segment_start = segment_end
+
+        self.covered_until = end
+
+    # Function to size a window from an expected density, limited to within a factor of two of the previous size
+    # and to the largest size that worked
+    def size_for(self, density, previous_days=None, max_days=MAX_DAYS):
+        days = TARGET_ORDERS / density if density else MAX_DAYS
+        if previous_days is not None:
+            days = min(max(days, previous_days / 2), previous_days * 2)
+        return min(max(days, MIN_DAYS), max_days)
+
+    # Function to fetch all work orders between start and stop, yielding (window_start, window_end, work_orders)
+    def fetch_windows(self, start, stop):
+        density = self.density(start)
+        days = self.size_for(density, max_days=self.max_days_for(start)) if density is not None else min(DEFAULT_DAYS, self.max_days_for(start))
+
+        window_start = start
+        while True:
+            days = min(days, self.max_days_for(window_start))
+            window_end = min(window_start + timedelta(days=days), stop)
+            window_days = (window_end - window_start) / timedelta(days=1)
+
+            try:
+                work_orders = self.fetch(window_start, window_end, timeout=REQUEST_TIMEOUT, wait_if_unavailable=False)
+            except (requests.exceptions.Timeout, ex.QualerUnavailableError) as e:
+                # Split the window that was actually sent, which the stop date may already have cut short
+                if window_days > MIN_DAYS:
+                    days = self.split(window_start, window_days)
+                    print(f"{e}. Splitting window to {days:g} days.")
+                    continue
+                # The window can't be split any further, so wait for Qualer as usual
+                work_orders = self.fetch(window_start, window_end)
+
+            self.record(window_start, window_end, len(work_orders))
+
+            # Refetch a large response in smaller windows, so later windows in this range stay under MAX_ORDERS.
+            # Its orders are already recorded, so the refetched windows don't count them again.
+            if len(work_orders) > MAX_ORDERS and window_days > MIN_DAYS:
+                days = self.split(window_start, window_days)
+                print(f"{len(work_orders)} orders in one window. Splitting window to {days:g} days.")
+                continue
+
+            yield window_start, window_end, work_orders
+
+            if window_end >= stop:
+                break
+
+            # Size the next window from this window's density: shrink after a dense one, widen after a sparse one
+            if window_days:
+                days = self.size_for(len(work_orders) / window_days, days, self.max_days_for(window_end))
+            window_start = window_end
+
+    # Function to save the order density history for future runs
+    def save(self):
+        history = {
+            "months": self.months,
+            "covered_until": self.covered_until.isoformat() if self.covered_until else None,
+        }
+        with open(self.history_path, 'w') as file:
+            json.dump(history, file, indent=2, sort_keys=True)
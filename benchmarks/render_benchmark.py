@@ -0,0 +1,155 @@
+import os
+import sys
+import timeit
+from datetime import datetime as dt
+from datetime import time, timedelta
+
+# Make the app package importable when run as "python benchmarks/render_benchmark.py"
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import app.render as render
+
+###########################################################################################
+########################### Microbenchmark: orders rendered per second ####################
+###########################################################################################
+
+ORDER_COUNT = 1000
+REPEAT = 5
+BODY_PATH = os.path.join(repo_root, "app", "body.html")
+
+# Attendees and asset count are fixed, so only parsing and rendering are measured (no API calls)
+ATTENDEES = [{"type": "required", "emailAddress": {"name": "Jane Doe", "address": "jdoe@jgiquality.com"}}]
+ASSET_COUNT = 12
+
+
+# Function to build a synthetic Qualer work order. Each order has its own date, so the parser caches rarely hit.
+def make_order(i):
+    day = (dt(2024, 1, 1) + timedelta(days=i)).strftime('%Y-%m-%d')
+    start = dt(1900, 1, 1, 7) + timedelta(minutes=15 * (i % 16))
+    return {
+        "ServiceOrderId": 1000000 + i,
+        "CustomOrderNumber": f"56561-{i:06d}",
+        "OrderStatus": ("Scheduling", "Processing", "Completed")[i % 3],
+        "ClientCompanyName": f"Client {i % 50}",
+        "ShippingAddress": {
+            "Address1": f"{i} Main St",
+            "City": "Tulsa",
+            "StateProvinceAbbreviation": "OK",
+            "ZipPostalCode": "74101",
+        },
+        "RequestFromDate": f"{day}T00:00:00",
+        "RequestToDate": f"{day}T00:00:00",
+        "RequestFromTime": start.strftime('%Y-%m-%dT%H:%M:%S'),
+        "RequestToTime": (start + timedelta(hours=8)).strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+# Function to build the Outlook side of the comparison for an order
+def make_outlook_event(event):
+    outlook_event = dict(event)
+    outlook_event["start"] = dict(event["start"], dateTime=event["start"]["dateTime"] + "0")
+    outlook_event["end"] = dict(event["end"], dateTime=event["end"]["dateTime"] + "0")
+    return outlook_event
+
+
+###########################################################################################
+############## Previous implementation, kept here as the baseline to compare with #########
+###########################################################################################
+
+def old_parse_datetime(datetime_str):
+    return dt.strptime(datetime_str, "%Y-%m-%dT%H:%M:%S")
+
+
+def old_combine_date_and_time(order):
+    request_from = dt.combine(old_parse_datetime(order["RequestFromDate"]).date(), old_parse_datetime(order["RequestFromTime"]).time())
+    request_to = dt.combine(old_parse_datetime(order["RequestToDate"]).date(), old_parse_datetime(order["RequestToTime"]).time())
+    if request_from > request_to and request_to.time() < time(12, 0):
+        request_to += timedelta(hours=12)
+    return request_from, request_to, False
+
+
+def old_prepare_event_as_json(order):
+    address = order["ShippingAddress"]
+    address_str = f"{address['Address1']}, {address['City']}, {address['StateProvinceAbbreviation']} {address['ZipPostalCode']}"
+    start_time, end_time, is_all_day = old_combine_date_and_time(order)
+    hyperlink = f'<a href="https://jgiquality.qualer.com/ServiceOrder/Info/{order["ServiceOrderId"]}">{order["CustomOrderNumber"]}</a>'
+    body_content = "<b>" + hyperlink + "<br> Number of Assets:</b> " + str(ASSET_COUNT)
+    with open(BODY_PATH, 'r') as file:
+        body_html = file.read()
+    body = body_html.replace('<p class="MsoNormal"></p>', '<p class="MsoNormal">' + body_content + '</p>')
+    return {
+        "subject": order["ClientCompanyName"],
+        "bodyPreview": order["CustomOrderNumber"],
+        "allowNewTimeProposals": False,
+        "body": {"contentType": "html", "content": body},
+        "isAllDay": is_all_day,
+        "start": {"dateTime": start_time.strftime('%Y-%m-%dT%H:%M:%S.%f'), "timeZone": "America/Chicago"},
+        "end": {"dateTime": end_time.strftime('%Y-%m-%dT%H:%M:%S.%f'), "timeZone": "America/Chicago"},
+        "location": {"displayName": address_str, "locationType": "default"},
+        "attendees": ATTENDEES,
+        "categories": [],
+        "showAs": "tentative" if order["OrderStatus"] == "Scheduling" else "busy" if order["OrderStatus"] == "Processing" else "free",
+        "responseRequested": False,
+        "isReminderOn": False,
+        "isCancelled": order["OrderStatus"] == "Cancelled",
+    }
+
+
+def old_coerce_datetime_format(string_datetime):
+    return dt.strptime(string_datetime, '%Y-%m-%dT%H:%M:%S.%f0').strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def old_reformat_event(event):
+    reformatted_event = {key: event[key] for key in render.COMPARED_KEYS}
+    reformatted_event['body'] = {'contentType': event['body']['contentType'], 'content': event['body']['content']}
+    reformatted_event['start'] = {'dateTime': old_coerce_datetime_format(event['start']['dateTime']), 'timeZone': event['start']['timeZone']}
+    reformatted_event['end'] = {'dateTime': old_coerce_datetime_format(event['end']['dateTime']), 'timeZone': event['end']['timeZone']}
+    reformatted_event['location'] = {'displayName': event['location']['displayName'], 'locationType': event['location']['locationType']}
+    reformatted_event['attendees'] = []
+    for attendee in event['attendees']:
+        attendee['emailAddress']['address'] = attendee['emailAddress']['address'].replace('.onmicrosoft', '')
+        reformatted_event['attendees'].append({'type': attendee['type'], 'emailAddress': attendee['emailAddress']})
+    return reformatted_event
+
+
+# Function to empty the datetime parser caches, so every timed run pays for strptime as a real run does
+def clear_caches():
+    render.parse_qualer_datetime.cache_clear()
+    render.parse_outlook_datetime.cache_clear()
+
+
+def main():
+    template = render.load_body_template(BODY_PATH)
+    orders = [make_order(i) for i in range(ORDER_COUNT)]
+    outlook_events = [make_outlook_event(render.render_event(render.parse_order(order), ATTENDEES, ASSET_COUNT, template)) for order in orders]
+
+    def render_all():
+        for order in orders:
+            render.render_event(render.parse_order(order), ATTENDEES, ASSET_COUNT, template)
+
+    def old_render_all():
+        for order in orders:
+            old_prepare_event_as_json(order)
+
+    def normalize_all():
+        for event in outlook_events:
+            render.normalize_outlook_event(event)
+
+    def old_normalize_all():
+        for event in outlook_events:
+            old_reformat_event(event)
+
+    benchmarks = (
+        ("render (Qualer side)", render_all, old_render_all),
+        ("normalize (Outlook side)", normalize_all, old_normalize_all),
+    )
+    for name, new_func, old_func in benchmarks:
+        new_best = min(timeit.repeat(new_func, setup=clear_caches, number=1, repeat=REPEAT))
+        old_best = min(timeit.repeat(old_func, number=1, repeat=REPEAT))
+        print(f"{name}: {ORDER_COUNT / new_best:,.0f} orders/sec, previously {ORDER_COUNT / old_best:,.0f} orders/sec "
+              f"({old_best / new_best:.1f}x, best of {REPEAT} x {ORDER_COUNT} orders, caches cleared before each run)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
+import argparse
 import logging
 from datetime import datetime as dt
-from datetime import time, timedelta
 import os
 import traceback
 from dotenv import load_dotenv, find_dotenv
@@ -17,6 +17,11 @@ print("Current Working Directory:", os.getcwd())
 import app.exceptions as ex
 import app.outlook as ol
 import app.qualer_api as q
+import app.plan as plan
+import app.render as render
+import app.technicians as technicians
+import app.tracing as tracing
+import app.windows as windows
 
 ##########################################################################################################
 ########################################### Initial Variables ############################################
@@ -25,6 +30,22 @@ import app.qualer_api as q
 LIVE = True  # Set to True to run the script in live mode, False to run in test mode
 LOG = True  # Set to True to enable logging, False to disable logging
 
+# Command line options: --plan writes the changes to a file instead of making them, --apply makes the changes in a saved plan,
+# --technician-calendars also writes to each technician's calendar, --trace exports the timing of each order's API calls
+parser = argparse.ArgumentParser(description="Sync Qualer work orders to the Outlook calendar")
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument("--plan", dest="plan_path", metavar="PATH", help="write a sync plan to PATH without changing Outlook (relative to this script)")
+mode.add_argument("--apply", dest="apply_path", metavar="PATH", help="apply the sync plan saved at PATH (relative to this script)")
+parser.add_argument("--technician-calendars", action="store_true", help="also keep events in each assigned technician's own calendar (can't be combined with --plan or --apply)")
+parser.add_argument("--trace", dest="trace_path", metavar="PATH", help="export per-order API call spans to PATH in the Chrome Trace Event format (relative to this script)")
+args = parser.parse_args()
+PLAN_PATH = args.plan_path
+APPLY_PATH = args.apply_path
+TRACE_PATH = args.trace_path
+TECHNICIAN_CALENDARS = args.technician_calendars
+if TECHNICIAN_CALENDARS and (PLAN_PATH or APPLY_PATH):
+    parser.error("--technician-calendars can't be combined with --plan or --apply, since plans don't include technician calendar writes")
+
 # Initialize counters for success and failure
 created_counter = 0
 deleted_counter = 0
@@ -37,78 +58,19 @@ exceptions = []
 created_events = []
 deleted_events = []
 updated_events = []
-last_week = False
 work_order_numbers = []
+planned_actions = []
+technician_sync = technicians.TechnicianSync(LIVE) if TECHNICIAN_CALENDARS else None
 
 ##########################################################################################################
 ########################################## Function Definitions ##########################################
 ##########################################################################################################
 
 
-# Function that parses datetimes for combine_date_and_time()
-def parse_datetime(datetime_str):
-    return dt.strptime(datetime_str, "%Y-%m-%dT%H:%M:%S")
-
-
-# Function to combine date and time for an order. If dates are missing, raises an exception. If times are both missing, assumes all day event.
-def combine_date_and_time(order):
-    required_fields = ["RequestFromTime", "RequestToTime", "RequestFromDate", "RequestToDate"]
-    # If no values are missing, assume the event is not all day
-    if all(isinstance(order.get(field), str) for field in required_fields):
-        request_from = dt.combine(parse_datetime(order["RequestFromDate"]).date(),
-                                  parse_datetime(order["RequestFromTime"]).time())
-        request_to = dt.combine(parse_datetime(order["RequestToDate"]).date(),
-                                parse_datetime(order["RequestToTime"]).time())
-        is_all_day = False
-        # Check if the event ends before it starts
-        if request_from > request_to:
-            # If both times are AM, and the end time is before the start time, assume the end time is supposed to be PM
-            if request_to.time() < time(12, 0):
-                request_to += timedelta(hours=12)
-                print("Order ends before it starts. Correcting end time from AM to PM on outlook.  Please make corrections on Qualer manually.")
-                print("https://jgiquality.qualer.com/ServiceOrder/Info/" + str(order["ServiceOrderId"]))
-            else:
-                raise Exception("Order ends before it starts. Make manual corrections on Qualer: https://jgiquality.qualer.com/ServiceOrder/Info/" + order["ServiceOrderId"])
-
-    # If the dates are present, check which of the times are missing
-    elif all(isinstance(order.get(field), str) for field in required_fields[2:]):
-        # If both times are missing, assume the event is all day
-        if all(order.get(field) is None for field in required_fields[:2]):
-            print(f"Order {order['ServiceOrderId']} has missing times. Assuming all day event.")
-            request_from = dt.combine(parse_datetime(order["RequestFromDate"]).date(), time.min)
-            request_to = dt.combine(parse_datetime(order["RequestToDate"]).date(), time.min) + timedelta(days=1)
-            is_all_day = True
-        # Use defualt times if only one of the times is missing
-        else:
-            default_start_time = time(7, 0)  # Default start time is 7:00 AM
-            default_end_time = time(17, 0)  # Default end time is 5:00 PM
-
-            start_time_str = order.get("RequestFromTime")
-            end_time_str = order.get("RequestToTime")
-
-            start_time = parse_datetime(start_time_str).time() if start_time_str else default_start_time
-            end_time = parse_datetime(end_time_str).time() if end_time_str else default_end_time
-
-            request_from = dt.combine(parse_datetime(order["RequestFromDate"]).date(), start_time)
-            request_to = dt.combine(parse_datetime(order["RequestToDate"]).date(), end_time)
-
-            is_all_day = False
-    else:
-        missing_values = [field for field in required_fields if not order.get(field)]
-        raise Exception("Order is missing values: " + ", ".join(missing_values) + ".")
-
-    return request_from, request_to, is_all_day
-
-
-# Function to prepare event data as json for an order
-def prepare_event_as_json(order):
+# Function to prepare event data as json for a parsed order
+def prepare_event_as_json(record):
+    service_order_id = record.service_order_id
     assignees = []  # Initialize list of assignees
-    service_order_id = order["ServiceOrderId"]
-    custom_order_number = order["CustomOrderNumber"]
-    order_status = order["OrderStatus"]
-    address = order["ShippingAddress"]
-    address_str = f"{address['Address1']}, {address['City']}, {address['StateProvinceAbbreviation']} {address['ZipPostalCode']}"
-    start_time, end_time, is_all_day = combine_date_and_time(order)
     order_assignments = q.get_work_order_assignments(service_order_id)
     for assignment in order_assignments:
         try:
@@ -116,102 +78,7 @@ def prepare_event_as_json(order):
         except Exception as e:
             print(e)
 
-    # Prepare body content for calendar event
-    hyperlink = f'<a href="https://jgiquality.qualer.com/ServiceOrder/Info/{service_order_id}">{custom_order_number}</a>'
-    body_content = "<b>" + hyperlink + "<br> Number of Assets:</b> " + str(q.count_assets(service_order_id))
-    with open("app/body.html", 'r') as file:  # Read the contents of body.html
-        body_html = file.read()
-    body = body_html.replace('<p class="MsoNormal"></p>', '<p class="MsoNormal">' + body_content + '</p>')
-
-    # Prepare dictionary object for Outlook calendar event
-    event = {
-        "subject": order["ClientCompanyName"],
-        "bodyPreview": custom_order_number,
-        "allowNewTimeProposals": False,
-        "body": {
-            "contentType": "html",
-            "content": body
-        },
-        "isAllDay": is_all_day,
-        "start": {
-            "dateTime": start_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
-            "timeZone": "America/Chicago"
-        },
-        "end": {
-            "dateTime": end_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
-            "timeZone": "America/Chicago"
-        },
-        "location": {
-            "displayName": address_str,
-            "locationType": "default"
-        },
-        "attendees": assignees,
-        "categories": [],
-        "showAs": "tentative" if order_status == "Scheduling" else "busy" if order_status == "Processing" else "free",
-        "responseRequested": False,
-        "isReminderOn": False,
-        "isCancelled": True if order_status == "Cancelled" else False,
-    }
-    return event
-
-
-def coerce_datetime_format(string_datetime):
-    datetime_obj = dt.strptime(string_datetime, '%Y-%m-%dT%H:%M:%S.%f0')    # Coercing the string to a datetime object
-    formatted_datetime = datetime_obj.strftime('%Y-%m-%dT%H:%M:%S.%f')      # Formatting the datetime object in the desired format
-    return formatted_datetime
-
-
-# Function to reformat an event to match the format of the event expected by the Outlook API
-def reformat_event(event):
-    reformatted_event = {}
-
-    # Keys to compare between Qualer and Outlook, to determine whether or not to update an event
-    keys_to_copy = [
-        'subject',
-        'bodyPreview',
-        'allowNewTimeProposals',
-        'isAllDay',
-        'categories',
-        'showAs',
-        'responseRequested',
-        'isReminderOn',
-        'isCancelled'
-    ]
-
-    for key in keys_to_copy:
-        reformatted_event[key] = event[key]
-
-    reformatted_event['body'] = {
-        'contentType': event['body']['contentType'],
-        'content': event['body']['content']
-    }
-
-    reformatted_event['start'] = {
-        'dateTime': coerce_datetime_format(event['start']['dateTime']),
-        'timeZone': event['start']['timeZone']
-    }
-
-    reformatted_event['end'] = {
-        'dateTime': coerce_datetime_format(event['end']['dateTime']),
-        'timeZone': event['end']['timeZone']
-    }
-
-    reformatted_event['location'] = {
-        'displayName': event['location']['displayName'],
-        'locationType': event['location']['locationType']
-    }
-
-    reformatted_event['attendees'] = []
-    for attendee in event['attendees']:
-        # Remove ".onmicrosoft" from email addresses, just in case it's there
-        attendee['emailAddress']['address'] = attendee['emailAddress']['address'].replace('.onmicrosoft', '')
-        attendee_info = {
-            'type': attendee['type'],
-            'emailAddress': attendee['emailAddress']
-        }
-        reformatted_event['attendees'].append(attendee_info)
-
-    return reformatted_event
+    return render.render_event(record, assignees, q.count_assets(service_order_id), body_template)
 
 
 # Function to find an event by its id from an outlook response
@@ -222,139 +89,200 @@ def find_event(event_id, all_outlook_events):
     return None
 
 
-# Function to compare two event objects and return a list of keys whose values differ between the two events
-def compare_events(event1, event2):
-    differing_keys = []
-    for key in event1:
-        if key == "body":  # or key == "bodyPreview":
-            continue  # Do not check the body or bodyPreview keys; there are too many formatting discrepancies
-        elif event1[key] != event2.get(key):
-            differing_keys.append(key)
-    return differing_keys
-
-
-# Function to process an order
-def process_order(order, id_array, is_live):
+# Function to determine what should happen to the Outlook event for an order, without writing anything
+def plan_order(order, id_array):
     event_id = ol.check_outlook_event(order["ServiceOrderId"], order["CustomOrderNumber"], id_array)
     if order.get("RequestToDate") is None:
         return None
 
-    request_to_date = parse_datetime(order["RequestToDate"]).date()
-    if request_to_date < dt.now().date():
-        return "Past"  # Skip the order if it has passed the RequestToDate
+    record = render.parse_order(order)
+    if record.to_date < dt.now().date():
+        return plan.make_action(order, "Past")  # Skip the order if it has passed the RequestToDate
+
+    # The shared calendar event lists the previous assignees, whose own calendars may still hold a copy to delete
+    shared_event = find_event(event_id, all_outlook_events) if event_id else None
 
     if order["OrderStatus"] == "Cancelled":
+        if technician_sync:
+            technician_sync.add(order, None, shared_event)
         if event_id:
-            ol.delete_outlook_event(event_id) if is_live else print(f"Would have deleted event for {order['CustomOrderNumber']} if live")
-            return "Cancelled"
+            return plan.make_action(order, "Cancelled", event_id)
         else:
-            return "Skipped"  # Skip the cancelled order if it does not have an event in Outlook.
+            return plan.make_action(order, "Skipped")  # Skip the cancelled order if it does not have an event in Outlook.
 
-    qualer_event_obj = prepare_event_as_json(order)
+    qualer_event_obj = prepare_event_as_json(record)
+    if technician_sync:
+        technician_sync.add(order, qualer_event_obj, shared_event)
 
     if event_id:
-        outlook_event_obj = reformat_event(find_event(event_id, all_outlook_events))
-        differing_keys = compare_events(outlook_event_obj, qualer_event_obj)
+        outlook_event_obj = render.normalize_outlook_event(shared_event)
+        differing_keys = render.compare_events(outlook_event_obj, qualer_event_obj)
         if not differing_keys:
             print(f"Event for {order['CustomOrderNumber']} is up to date")
-            return "Skipped"  # Skip if the changes to the order are irrelevant to the calendar event
+            return plan.make_action(order, "Skipped", event_id)  # Skip if the changes to the order are irrelevant to the calendar event
         else:
-            ol.update_outlook_event(event_id, qualer_event_obj, differing_keys == ['attendees']) if is_live else print(f"Would have updated event for {order['CustomOrderNumber']} if live")
-            return "Updated"
+            return plan.make_action(order, "Updated", event_id, differing_keys, qualer_event_obj)
     else:
-        ol.create_outlook_event(qualer_event_obj) if is_live else print(f"Would have created event for {order['CustomOrderNumber']} if live")
-        return "Created"
+        return plan.make_action(order, "Created", payload=qualer_event_obj)
 
 
-###########################################################################################
-#################################### Main script ##########################################
-###########################################################################################
-
-# Get the last log time from the log file
-last_log = ex.get_last_log_time()
-last_log_datetime = dt.strptime(last_log, "%Y-%m-%d %H:%M:%S,%f")
+# Function to process an order
+def process_order(order, id_array, is_live):
+    action = plan_order(order, id_array)
+    if action is None:
+        return None
 
-# Define the start and stop dates
-start_date = last_log_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
-stop_date = dt.now()  # Use the current date as the stop date
-print(start_date, stop_date)
+    if action["result"] in plan.WRITE_RESULTS:
+        plan.apply_action(action) if is_live else print(plan.describe_action(action))
+    return action["result"]
 
-# Get all Outlook events, and extract the event id's into a table
-all_outlook_events = ol.get_outlook_events()
-id_array = ol.extract_event_details(all_outlook_events)
-print(f"Found {len(id_array)} events in Outlook")
 
-# Construct the file path relative to the current directory
-html_file_path = os.path.join(os.getcwd(), "app", "body.html")
+# Function to update the counters and order lists for the result of an order
+def record_result(result, custom_order_number):
+    global created_counter, deleted_counter, updated_counter, skipped_counter
 
-# Open the file for reading or show an error message
-try:
-    with open(html_file_path, 'r') as file:
-        body_html = file.read()
-except FileNotFoundError:
-    print(f"File {html_file_path} does not exist.")
+    if result == "Past" or result == "Skipped":
+        skipped_counter += 1
+    elif result == "Cancelled":
+        deleted_events.append(int(custom_order_number[6:]))
+        deleted_counter += 1
+    elif result == "Updated":
+        updated_events.append(int(custom_order_number[6:]))
+        updated_counter += 1
+    elif result == "Created":
+        created_events.append(int(custom_order_number[6:]))
+        created_counter += 1
 
-# Set the initial week start and week end dates
-week_start = start_date
-week_end = start_date + timedelta(days=7)
 
-# Run the loop until the week end date is equal to or exceeds the stop date
-while week_start <= stop_date:
+# Function to record a failed order
+def record_failure(custom_order_number, message):
+    global failure_counter
 
-    # Check to see if the week end date exceeds the stop date
-    if (week_end > stop_date):
-        week_end = stop_date
-        last_week = True
+    failure_counter += 1
+    exceptions.append([custom_order_number[6:], message])
 
-    # Call the get_work_orders function from ./app/qualer_api.py for the current week
-    work_orders = q.get_work_orders(week_start, week_end)
-    print(f"Found {len(work_orders)} records between {week_start.strftime('%Y-%m-%d')} and {week_end.strftime('%Y-%m-%d')}")
 
-    # Loop through each work order
-    for order in work_orders:
-        try:
-            event_id = ol.check_outlook_event(order["ServiceOrderId"], order["CustomOrderNumber"], id_array)
-            result = process_order(order, id_array, LIVE)
-
-            if result == "Past" or result == "Skipped":
-                skipped_counter += 1
-                continue
-            elif result == "Cancelled":
-                deleted_events.append(int(order["CustomOrderNumber"][6:]))
-                deleted_counter += 1
-            elif result == "Updated":
-                updated_events.append(int(order["CustomOrderNumber"][6:]))
-                updated_counter += 1
-            elif result == "Created":
-                created_events.append(int(order["CustomOrderNumber"][6:]))
-                created_counter += 1
-
-        except ValueError:
-            failure_counter += 1
-            exceptions.append([order["CustomOrderNumber"][6:], traceback.format_exc()])
-        except Exception as e:
-            failure_counter += 1
-            exceptions.append([order["CustomOrderNumber"][6:], str(e)])
+###########################################################################################
+#################################### Main script ##########################################
+###########################################################################################
 
-    if (last_week):
-        break
+if APPLY_PATH:
+    # Apply a saved sync plan without fetching anything from Qualer or Outlook
+    saved_plan = plan.load_plan(APPLY_PATH)
+    plan.print_estimate(saved_plan)
+
+    # If a sync ran after the plan was written, it may already have created or updated these events.
+    # Their saved payloads are out of date, so only the deletions are still applied.
+    stale = plan.is_stale(saved_plan, ex.get_last_log_time())
+    if stale:
+        print(f"A sync has run since this plan was written ({saved_plan['created']}). Skipping its creates and updates; run --plan again to refresh them.")
+
+    pending_actions = []
+    for action in saved_plan["actions"]:
+        if action.get("applied"):
+            print(f"Event for {action['CustomOrderNumber']} was already {plan.WRITE_RESULTS[action['result']]} by an earlier apply")
+            record_result("Skipped", action["CustomOrderNumber"])
+        elif action["result"] not in plan.WRITE_RESULTS:
+            record_result(action["result"], action["CustomOrderNumber"])
+        elif stale and action["result"] in ("Created", "Updated"):
+            record_result("Skipped", action["CustomOrderNumber"])
+        elif not LIVE:
+            print(plan.describe_action(action))
+            record_result(action["result"], action["CustomOrderNumber"])
+        else:
+            pending_actions.append(action)
 
-    # Update the week start and week end dates for the next iteration
-    week_start = week_end
-    week_end = week_start + timedelta(days=7)
+    # Apply the remaining writes in bulk, in $batch calls of up to 20 requests
+    try:
+        for action, error in plan.apply_actions(pending_actions):
+            if error:
+                record_failure(action["CustomOrderNumber"], error)
+            else:
+                action["applied"] = True
+                record_result(action["result"], action["CustomOrderNumber"])
+    except Exception as e:
+        # A failed batch call leaves the rest of the plan unapplied, to be retried with another --apply
+        for action in pending_actions:
+            if not action.get("applied"):
+                record_failure(action["CustomOrderNumber"], str(e))
+    finally:
+        # Mark the applied actions in the plan file, so applying it again doesn't repeat them
+        if LIVE:
+            plan.save_plan(APPLY_PATH, saved_plan)
+
+else:
+    # Get the last log time from the log file
+    last_log = ex.get_last_log_time()
+    last_log_datetime = dt.strptime(last_log, "%Y-%m-%d %H:%M:%S,%f")
+
+    # Define the start and stop dates
+    start_date = last_log_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+    stop_date = dt.now()  # Use the current date as the stop date
+    print(start_date, stop_date)
+
+    # Get all Outlook events, and extract the event id's into a table
+    all_outlook_events = ol.get_outlook_events()
+    id_array = ol.extract_event_details(all_outlook_events)
+    print(f"Found {len(id_array)} events in Outlook")
+
+    # Load and precompile the event body template once for the whole run
+    body_template = render.load_body_template(os.path.join(os.getcwd(), "app", "body.html"))
+
+    # Fetch the work orders in windows sized from the order density of recent windows and previous runs
+    window_planner = windows.WindowPlanner(q.get_work_orders, os.path.join("app", "window_history.json"))
+    for window_start, window_end, work_orders in window_planner.fetch_windows(start_date, stop_date):
+        print(f"Found {len(work_orders)} records between {window_start.strftime('%Y-%m-%d')} and {window_end.strftime('%Y-%m-%d')}")
+
+        # Loop through each work order
+        for order in work_orders:
+            try:
+                with tracing.order(order["CustomOrderNumber"]):
+                    if PLAN_PATH:
+                        action = plan_order(order, id_array)
+                        if action is not None:
+                            planned_actions.append(action)
+                        result = action and action["result"]
+                    else:
+                        result = process_order(order, id_array, LIVE)
+                record_result(result, order["CustomOrderNumber"])
+
+            except ValueError:
+                record_failure(order["CustomOrderNumber"], traceback.format_exc())
+            except Exception as e:
+                record_failure(order["CustomOrderNumber"], str(e))
+
+    # Plan and test runs change nothing, so only live runs update the order density history
+    if LIVE and not PLAN_PATH:
+        window_planner.save()
+
+    # Write the events rendered above to the technicians' own calendars
+    if technician_sync:
+        technician_results = technician_sync.run()
+        for order_number, message in technician_sync.exceptions:
+            record_failure(order_number, message)
+
+    if PLAN_PATH:
+        written_plan = plan.write_plan(PLAN_PATH, planned_actions, start_date, stop_date, q.call_counts, ol.call_counts)
+        print(f"Wrote sync plan with {len(planned_actions)} orders to {PLAN_PATH}")
+        plan.print_estimate(written_plan)
 
 
 ###########################################################################################
 ###################################### Logging ############################################
 ###########################################################################################
 
-# Logging
-if LOG:
+# Logging (a plan run changes nothing, so it is not logged)
+if LOG and not PLAN_PATH:
     ex.group_orders_by_exception(exceptions)  # log the exceptions
     logging.info(f"Successfully created orders: {created_events}") if created_events else None
     logging.info(f"Successfully updated orders: {updated_events}") if updated_events else None
     logging.info(f"Successfully deleted orders: {deleted_events}") if deleted_events else None
 
+    # The next sync starts from the last log time. After an apply, that must be the end of the plan's window, not now,
+    # so orders changed between planning and applying are still fetched next time.
+    if APPLY_PATH:
+        ex.log_cursor(f"Applied sync plan {APPLY_PATH}", dt.fromisoformat(saved_plan["window"]["stop"]))
+
 
 print()
 
@@ -371,3 +299,12 @@ print(f"Deleted: {deleted_counter}")
 print(f"Skipped: {skipped_counter}")
 print(f"Failed: {failure_counter}")
 print()
+if technician_sync:
+    print(f"Technician calendars: Created: {technician_results['Created']}, Updated: {technician_results['Updated']}, Deleted: {technician_results['Cancelled']}, Skipped: {technician_results['Skipped']}")
+    print()
+
+# Print the slowest and most API-heavy orders, and export the spans if requested
+tracing.print_report()
+if TRACE_PATH:
+    tracing.export_chrome_trace(TRACE_PATH)
+    print(f"Wrote trace to {TRACE_PATH}")